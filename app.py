@@ -1,14 +1,26 @@
 import streamlit as st
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import folium
 import leafmap.foliumap as leafmap
-from streamlit_folium import st_folium
+import shapely
 from shapely.geometry import Point
 from folium.plugins import MarkerCluster
 from folium.plugins import FastMarkerCluster
+from folium.plugins import HeatMap
+from pyproj import CRS, Transformer
+from numba import njit
+from numba.typed import List
+import pyarrow.parquet as pq
 import gdown
+import glob
+import hashlib
+import html
+import inspect
+import json
 import os
 
 # st.cache_data.clear()
@@ -44,6 +56,11 @@ DATA_FILES = {
     'relaves': 'Relaves_Chile.parquet',
     'regiones': 'Regiones_Chile.parquet'
 }
+N_RELAVES_CERCANOS = 10
+MAP_DECIMALS = 5  # ~1 m en latitud, suficiente para los marcadores
+
+# Transformación WGS84 -> UTM 19S para puntos individuales
+WGS84_A_UTM = Transformer.from_crs(4326, 32719, always_xy=True)
 
 # Diccionario de regiones
 ROMANO_A_REGION = {
@@ -66,6 +83,13 @@ ROMANO_A_REGION = {
 }
 
 # Funciones de utilidad
+@st.cache_resource
+def get_http_session():
+    """Sesión HTTP compartida con keep-alive para reutilizar conexiones TLS"""
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
 @st.cache_data(ttl=3600) 
 def geocode(query):
     """Geocodifica una dirección usando OpenRouteService"""
@@ -74,9 +98,11 @@ def geocode(query):
         'text': query
     }
 
-    response = requests.get(
+    # Los errores de red se propagan para que st.cache_data no los guarde
+    response = get_http_session().get(
         'https://api.openrouteservice.org/geocode/search',
-        params=parameters
+        params=parameters,
+        timeout=5
     )
     
     if response.status_code == 200:
@@ -94,10 +120,25 @@ DRIVE_FILE_IDS = {
     'Regiones_Chile': '11V8HQvoDBZpkORoj9lhXB7vzr16XLYTn'     
 }
 
-@st.cache_data(ttl=3600)
+# Directorio local para los archivos descargados
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+FULL_MAP_HTML = os.path.join(DATA_DIR, 'full_map_{}_{}.html')
+
+def geo_metadata(table):
+    """Obtiene la columna de geometría y el CRS desde los metadatos GeoParquet"""
+    geo = json.loads(table.schema.metadata[b'geo'])
+    column = geo['primary_column']
+    info = geo['columns'][column]
+    crs = info.get('crs', 'OGC:CRS84')
+    if isinstance(crs, dict):
+        crs = CRS.from_json_dict(crs)
+    return column, info.get('encoding'), crs
+
+@st.cache_resource
 def load_data(file_key):
     """Descarga y carga el archivo Parquet desde Google Drive"""
-    file_name = f"{file_key}.parquet"
+    os.makedirs(DATA_DIR, exist_ok=True)
+    file_name = os.path.join(DATA_DIR, f"{file_key}.parquet")
     file_id = DRIVE_FILE_IDS[file_key]
     
     # Descargar si no existe localmente
@@ -105,83 +146,153 @@ def load_data(file_key):
         url = f"https://drive.google.com/uc?id={file_id}"
         gdown.download(url, file_name, quiet=False)
     
-    # Cargar el Parquet
-    return gpd.read_parquet(file_name)
+    # Cargar el Parquet con memory map; solo la geometría se decodifica con shapely
+    table = pq.read_table(file_name, memory_map=True)
+    metadata = table.schema.metadata or {}
+    if b'geo' not in metadata:
+        return gpd.read_parquet(file_name)
+    geometry_column, encoding, crs = geo_metadata(table)
+    if encoding != 'WKB':
+        # Codificaciones nativas de GeoArrow (GeoParquet 1.1): las resuelve geopandas
+        return gpd.read_parquet(file_name)
+    geometry = shapely.from_wkb(table.column(geometry_column).to_numpy())
+    df = table.drop_columns([geometry_column]).to_pandas(types_mapper=pd.ArrowDtype)
+    return gpd.GeoDataFrame(df, geometry=geometry, crs=crs)
  
-@st.cache_data(ttl=3600, persist=True)
-def get_crs_transformed(_gdf, epsg, cache_key=None):
-    """Transforma el sistema de coordenadas con clave de caché única"""
-    return _gdf.to_crs(epsg=epsg)
+def extract_rings(geom):
+    """Extrae las coordenadas de todos los anillos de un (Multi)Polygon y sus offsets"""
+    rings = shapely.get_rings(shapely.get_parts(geom))
+    coords = np.ascontiguousarray(shapely.get_coordinates(rings), dtype=np.float64)
+    offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(shapely.get_num_coordinates(rings))
+    return coords, offsets
+
+@njit(cache=True)
+def point_in_rings(px, py, coords, offsets):
+    """Prueba punto-en-polígono por cruce de rayos (regla par-impar sobre todos los anillos)"""
+    inside = False
+    for r in range(offsets.size - 1):
+        j = offsets[r + 1] - 1
+        for i in range(offsets[r], offsets[r + 1]):
+            xi, yi = coords[i, 0], coords[i, 1]
+            xj, yj = coords[j, 0], coords[j, 1]
+            if (yi > py) != (yj > py) and px < (xj - xi) * (py - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+    return inside
+
+@njit(cache=True)
+def find_containing_region(px, py, candidatas, rings_coords, rings_offsets):
+    """Retorna la primera región candidata que contiene el punto, o -1"""
+    for c in candidatas:
+        if point_in_rings(px, py, rings_coords[c], rings_offsets[c]):
+            return c
+    return -1
 
 @st.cache_data(ttl=3600)  
-def find_region_for_point(lat, lon, _regiones_gdf):
-    """Encuentra la región para un punto dado"""
-    regiones_gdf = _regiones_gdf.copy()
+def find_region_for_point(lat, lon):
+    """Encuentra la región para un punto dado usando el índice espacial"""
+    data = initialize_data()
+    
+    # Descartar con 4 comparaciones los puntos fuera de la extensión de todas las regiones
+    min_lon, min_lat, max_lon, max_lat = data['regiones_extent']
+    if not (min_lon <= lon <= max_lon and min_lat <= lat <= max_lat):
+        return None
+    
     punto_wgs84 = Point(lon, lat)
     
-    for idx, region in regiones_gdf.iterrows():
-        if punto_wgs84.within(region.geometry):
-            return region
+    # Candidatas por envolvente y desempate con la prueba punto-en-polígono compilada
+    candidatas = data['regiones_tree'].query(punto_wgs84).astype(np.int64)
+    idx = find_containing_region(lon, lat, candidatas, *data['regiones_rings'])
+    if idx >= 0:
+        return data['regiones_wgs84'].iloc[idx]
     return None
 
 @st.cache_data(ttl=3600)
-def calculate_distances_to_relaves(lat, lon, _relaves_region_utm, region_name):
+def calculate_distances_to_relaves(lat, lon, region_name):
     """Calcula distancias a relaves y retorna los más cercanos"""
+    data = initialize_data()
+    idx_region = data['region_to_idx'][region_name]
+    xy_region_utm = data['region_xy_utm'][region_name]
+    
     # Crear punto en UTM
-    punto_utm = gpd.GeoDataFrame(
-        geometry=[Point(lon, lat)], 
-        crs="EPSG:4326"
-    ).to_crs(epsg=32719).geometry.iloc[0]
+    px, py = WGS84_A_UTM.transform(lon, lat)
     
-    # Calcular distancias
-    relaves_copy = _relaves_region_utm.copy()
-    relaves_copy['distancia'] = relaves_copy.geometry.distance(punto_utm)
-    relaves_copy = relaves_copy.sort_values('distancia')
+    # Distancias euclidianas vectorizadas sobre las coordenadas UTM
+    d = np.hypot(xy_region_utm[:, 0] - px, xy_region_utm[:, 1] - py)
     
-    # Obtener los 10 más cercanos
-    relaves_cercanos = relaves_copy.head(10).copy()
-    relaves_cercanos['distancia_km'] = relaves_cercanos['distancia'] / 1000
+    # Obtener los 10 más cercanos con ordenamiento parcial
+    k = min(N_RELAVES_CERCANOS, d.size)
+    idx = np.argpartition(d, k - 1)[:k]
+    idx = idx[np.argsort(d[idx])]
     
-    return relaves_cercanos
+    # Solo se materializan las filas de los más cercanos
+    return data['relaves'].iloc[idx_region[idx]].assign(
+        distancia=d[idx],
+        distancia_km=d[idx] / 1000.0
+    )
 
-@st.cache_data(ttl=3600)
-def create_full_map(_relaves_gdf):
-    def create_icon_callback(icon_name="map-marker", markerColor="red"):
-        return f"""\
-            function (row) {{
-                var icon, marker;
-                icon = L.AwesomeMarkers.icon({{
-                    icon: "{icon_name}", 
-                    markerColor: "{markerColor}"
-                }});
-                marker = L.marker(new L.LatLng(row[0], row[1]));
-                marker.setIcon(icon);
-                return marker;
-            }};
-            """
-        
+def display_text(value):
+    """Valor de atributo para mostrar; los faltantes (pd.NA/NaN) quedan vacíos"""
+    return '' if pd.isna(value) else str(value)
+
+def display_text_column(series):
+    """Columna de atributos como texto, con los faltantes vacíos"""
+    return series.astype('string').fillna('')
+
+def to_map_locations(latlon):
+    """Convierte un arreglo [lat, lon] en lista para Folium, redondeada para aligerar el JSON"""
+    return np.round(latlon.astype(np.float64), MAP_DECIMALS).tolist()
+
+def create_icon_callback(icon_name="map-marker", markerColor="red", prefix="glyphicon", bind="tooltip"):
+    """Callback JS de FastMarkerCluster; si la fila trae un tercer valor se usa como tooltip o popup"""
+    bind_js = (
+        "marker.bindPopup(row[2]);" if bind == "popup"
+        else "marker.bindTooltip(row[2], {sticky: true});"
+    )
+    return f"""\
+        function (row) {{
+            var icon, marker;
+            icon = L.AwesomeMarkers.icon({{
+                icon: "{icon_name}", 
+                markerColor: "{markerColor}",
+                prefix: "{prefix}"
+            }});
+            marker = L.marker(new L.LatLng(row[0], row[1]));
+            marker.setIcon(icon);
+            if (row.length > 2) {{
+                {bind_js}
+            }}
+            return marker;
+        }};
+        """
+
+def create_full_map(_relaves_df, _relaves_latlon, marcadores=True):
     m = folium.Map(
         location=[-35.675147, -71.542969],
         zoom_start=5,
-        tiles='CyclOSM'
+        tiles='CyclOSM',
+        prefer_canvas=True
     )
     
     # Preparar datos
-    locations = list(zip(
-        _relaves_gdf.geometry.y,
-        _relaves_gdf.geometry.x
-    ))
-    
-    popups = [
-        f"<b>{row['NOMBRE INSTALACION']}</b><br>Región: {row['Region']}"
-        for _, row in _relaves_gdf.iterrows()
-    ]
+    locations = to_map_locations(_relaves_latlon)
     
+    # Vista liviana: una sola capa de calor en canvas en lugar de miles de marcadores
+    if not marcadores:
+        HeatMap(data=locations, name="Relaves", radius=12).add_to(m)
+        return m
+    
+    popups = (
+        '<b>' + display_text_column(_relaves_df['NOMBRE INSTALACION'])
+        + '</b><br>Región: ' + display_text_column(_relaves_df['Region'])
+    ).tolist()
+    
+    # FastMarkerCluster no acepta popups aparte: viajan como tercer valor de cada fila
     FastMarkerCluster(
-        data=locations,
-        popups=popups,
+        data=[[y, x, popup] for (y, x), popup in zip(locations, popups)],
         name="Relaves",
-        callback=create_icon_callback('map-marker', 'blue'),
+        callback=create_icon_callback('map-marker', 'blue', bind='popup'),
         options={
             'disableClusteringAtZoom': 12,
             'maxClusterRadius': 40
@@ -189,38 +300,188 @@ def create_full_map(_relaves_gdf):
     ).add_to(m)
     
     return m
+
+def full_map_render_version():
+    """Hash del código y parámetros que definen el HTML del mapa general"""
+    fuentes = [
+        inspect.getsource(func) for func in
+        (create_full_map, create_icon_callback, to_map_locations, display_text_column)
+    ]
+    fuentes += [str(MAP_DECIMALS), folium.__version__]
+    return hashlib.sha1('\n'.join(fuentes).encode('utf-8')).hexdigest()[:12]
+
+@st.cache_resource
+def full_map_html(_relaves_df, _relaves_latlon, marcadores, version):
+    """HTML estático del mapa general, renderizado una sola vez por versión junto a los Parquet"""
+    relaves_file = os.path.join(DATA_DIR, 'Relaves_Chile.parquet')
+    modo = 'marcadores' if marcadores else 'calor'
+    html_file = FULL_MAP_HTML.format(modo, version)
+    
+    # Regenerar si no existe para esta versión del código o si los datos son más nuevos
+    if (not os.path.exists(html_file)
+            or os.path.getmtime(html_file) < os.path.getmtime(relaves_file)):
+        contenido = create_full_map(_relaves_df, _relaves_latlon, marcadores).get_root().render()
+        with open(html_file, 'w', encoding='utf-8') as f:
+            f.write(contenido)
+        
+        # Eliminar las versiones anteriores del mismo modo
+        for old_file in glob.glob(FULL_MAP_HTML.format(modo, '*')):
+            if old_file != html_file:
+                os.remove(old_file)
     
+    with open(html_file, encoding='utf-8') as f:
+        return f.read()
+
 @st.cache_data(ttl=3600)
+def render_result_map_html(lat, lon, region_name, address):
+    """Renderiza a HTML el mapa de resultados; depende solo de la consulta"""
+    data = initialize_data()
+    idx_region = data['region_to_idx'][region_name]
+    latlon_region = data['relaves_latlon'][idx_region]
+    relaves_df = data['relaves']
+    
+    relaves_cercanos = calculate_distances_to_relaves(lat, lon, region_name)
+    relave_cercano = relaves_cercanos.iloc[0]
+    relave_lat, relave_lon = data['relaves_latlon'][relave_cercano.name].tolist()
+    
+    # Crear mapa
+    m = folium.Map(
+        location=[lat, lon],
+        zoom_start=12,
+        tiles='CyclOSM',
+        prefer_canvas=True
+    )
+    
+    # Añadir marcador de la dirección ingresada
+    folium.Marker(
+        [lat, lon],
+        popup=folium.Popup(f"<b>Dirección ingresada:</b><br>{html.escape(address)}", max_width=200),
+        tooltip="Tu ubicación",
+        icon=folium.Icon(color='green', icon='home', prefix='fa')
+    ).add_to(m)
+    
+    # Añadir marcador del relave más cercano
+    
+    
+    # Añadir línea de conexión
+    folium.PolyLine(
+        locations=[[lat, lon], [relave_lat, relave_lon]],
+        color='blue',
+        weight=3,
+        opacity=0.8,
+        dash_array='10, 5',
+        popup=f"Distancia: {relave_cercano['distancia']:.0f} metros"
+    ).add_to(m)
+    
+    # Ajustar vista del mapa
+    bounds = [[lat, lon], [relave_lat, relave_lon]]
+    m.fit_bounds(bounds, padding=[20, 20])
+    
+    # Añadir otros relaves cercanos
+    if len(relaves_cercanos) > 1:
+        locations = to_map_locations(latlon_region)
+        
+        tooltips = (
+            '<b>' + display_text_column(relaves_df['NOMBRE INSTALACION'].iloc[idx_region])
+            + '</b><br>Región: ' + display_text_column(relaves_df['Region'].iloc[idx_region])
+            + '<br>Empresa: '
+            + display_text_column(relaves_df['NOMBRE_EMPRESA_O_PRODUCTOR_MINERO'].iloc[idx_region])
+        ).tolist()
+        
+        # Un solo cluster en JS en lugar de un Marker por relave
+        FastMarkerCluster(
+            data=[[y, x, tooltip] for (y, x), tooltip in zip(locations, tooltips)],
+            name="Relaves de la región",
+            callback=create_icon_callback('map-pin', 'blue', prefix='fa'),
+            options={
+                'disableClusteringAtZoom': 12,
+                'maxClusterRadius': 40
+            }
+        ).add_to(m)
+
+    folium.CircleMarker(
+        [relave_lat, relave_lon],
+        # popup=folium.Popup(
+            # f"<b>{relave_cercano['NOMBRE INSTALACION']}</b><br>"
+            # f"Empresa: {relave_cercano['NOMBRE_EMPRESA_O_PRODUCTOR_MINERO']}<br>"
+            # f"Distancia: {relave_cercano['distancia']:.0f} metros",
+            # max_width=300
+        # ),
+        # tooltip="Relave más cercano",
+        # icon=folium.Icon(color='red', icon='industry', prefix='fa')
+    ).add_to(m)
+    
+    return m.get_root().render()
+
+def is_mobile():
+    """Detecta un navegador móvil a partir del User-Agent de la sesión"""
+    return 'Mobi' in st.context.headers.get('User-Agent', '')
+    
+@st.cache_resource
 def initialize_data():
-    """Inicializa todos los datos necesarios de una vez"""
+    """Inicializa todos los datos e índices espaciales necesarios de una vez"""
     relaves_gdf = load_data('Relaves_Chile')
     regiones_gdf = load_data('Regiones_Chile')
     
-    # Transformaciones de coordenadas
-    relaves_gdf_utm = get_crs_transformed(relaves_gdf, 32719, cache_key="relaves_utm")
-    regiones_gdf_utm = get_crs_transformed(regiones_gdf, 32719, cache_key="regiones_utm")
-    relaves_gdf_wgs84 = get_crs_transformed(relaves_gdf, 4326, cache_key="relaves_wgs84")
-    regiones_gdf_wgs84 = get_crs_transformed(regiones_gdf, 4326, cache_key="regiones_wgs84")
+    # Transformaciones de coordenadas: las regiones solo se usan en WGS84
+    regiones_gdf_wgs84 = regiones_gdf.to_crs(epsg=4326)
+    
+    # Los relaves son puntos: atributos en un DataFrame y coordenadas (x, y) en arreglos
+    # numpy por CRS. El índice queda igual a la posición de fila en los arreglos.
+    # Se proyectan en bloque: una sola llamada a PROJ por CRS.
+    x, y = relaves_gdf.geometry.x.values, relaves_gdf.geometry.y.values
+    lon, lat = Transformer.from_crs(relaves_gdf.crs, 4326, always_xy=True).transform(x, y)
+    utm_x, utm_y = WGS84_A_UTM.transform(lon, lat)
+    relaves_xy_wgs84 = np.c_[lon, lat].astype(np.float32)
+    # UTM se mantiene en float64: con northings de ~7e6 m float32 solo resuelve 0,5 m
+    relaves_xy_utm = np.c_[utm_x, utm_y]
+    # Los mapas de Folium reciben [lat, lon]: se guarda ya en ese orden
+    relaves_latlon = np.ascontiguousarray(relaves_xy_wgs84[:, ::-1])
     
-    relaves_gdf_wgs84['Region'] = relaves_gdf_wgs84['REGION'].map(ROMANO_A_REGION)
-    relaves_gdf_utm['Region'] = relaves_gdf_utm['REGION'].map(ROMANO_A_REGION)
+    relaves_df = pd.DataFrame(relaves_gdf.drop(columns=relaves_gdf.geometry.name))
+    relaves_df.index = pd.RangeIndex(len(relaves_df))
+    relaves_df['Region'] = relaves_df['REGION'].map(ROMANO_A_REGION)
+
+    # Índice espacial de regiones y anillos de cada polígono para la prueba compilada
+    regiones_tree = shapely.STRtree(regiones_gdf_wgs84.geometry.values)
+    regiones_extent = tuple(regiones_gdf_wgs84.total_bounds.tolist())
+    rings_coords, rings_offsets = List(), List()
+    for geom in regiones_gdf_wgs84.geometry.values:
+        coords, offsets = extract_rings(geom)
+        rings_coords.append(coords)
+        rings_offsets.append(offsets)
+
+    # Índices de fila de los relaves de cada región
+    regiones_relaves = relaves_df['Region'].to_numpy()
+    region_to_idx = {
+        name: np.flatnonzero(regiones_relaves == name)
+        for name in ROMANO_A_REGION.values()
+    }
+
+    # Coordenadas UTM contiguas de los relaves de cada región (metros)
+    region_xy_utm = {
+        region: np.ascontiguousarray(relaves_xy_utm[idx])
+        for region, idx in region_to_idx.items()
+    }
 
     return {
-        'relaves_utm': relaves_gdf_utm,
-        'regiones_utm': regiones_gdf_utm,
-        'relaves_wgs84': relaves_gdf_wgs84,
-        'regiones_wgs84': regiones_gdf_wgs84
+        'relaves': relaves_df,
+        'relaves_latlon': relaves_latlon,
+        'regiones_wgs84': regiones_gdf_wgs84,
+        'regiones_tree': regiones_tree,
+        'regiones_rings': (rings_coords, rings_offsets),
+        'regiones_extent': regiones_extent,
+        'region_to_idx': region_to_idx,
+        'region_xy_utm': region_xy_utm
     }
 
             
 # Inicializar datos una sola vez
 with st.spinner('Cargando datos geográficos...'):
     data = initialize_data()
-    relaves_gdf_utm = data['relaves_utm']
-    regiones_gdf_utm = data['regiones_utm']
-    relaves_gdf_wgs84 = data['relaves_wgs84']
-    regiones_gdf_wgs84 = data['regiones_wgs84']
-
+    relaves_df = data['relaves']
+    relaves_latlon = data['relaves_latlon']
+    region_to_idx = data['region_to_idx']
     
 
 # Interfaz de usuario
@@ -229,28 +490,26 @@ address = st.text_input('Ingresa una dirección en Chile:',
 
 if address:
     with st.spinner('Buscando ubicación y relaves cercanos...'):
-        results = geocode(address)
+        try:
+            results = geocode(address)
+        except requests.RequestException:
+            results = None
         
         if results:
             lat, lon = results
             st.success(f'📍 Ubicación encontrada: {lat:.5f}, {lon:.5f}')
             
             # Buscar región 
-            region_encontrada = find_region_for_point(lat, lon, regiones_gdf_wgs84)
+            region_encontrada = find_region_for_point(lat, lon)
             
             if region_encontrada is not None and 'Region' in region_encontrada:
                 st.subheader(f"Región: {region_encontrada['Region']}")
                 
                 # Filtrar relaves de la región
-                relaves_region_utm = relaves_gdf_utm[
-                    relaves_gdf_utm['Region'] == region_encontrada['Region']
-                ]
-                relaves_region_wgs84 = relaves_gdf_wgs84[
-                        relaves_gdf_wgs84['Region'] == region_encontrada['Region']
-                ]
+                idx_region = region_to_idx.get(region_encontrada['Region'], np.empty(0, dtype=np.int64))
                     
-                numero_relaves_region = len(relaves_region_wgs84)
-                numero_relaves_total = len(relaves_gdf_wgs84)
+                numero_relaves_region = len(idx_region)
+                numero_relaves_total = len(relaves_df)
                 porcentaje_relaves = (numero_relaves_region/numero_relaves_total)*100
                 
                 if numero_relaves_region == 0:
@@ -261,31 +520,31 @@ if address:
                     
                     # Calcular distancias 
                     relaves_cercanos = calculate_distances_to_relaves(
-                        lat, lon, relaves_region_utm, region_encontrada['Region']
+                        lat, lon, region_encontrada['Region']
                     )
                     
                     # Mostrar tabla con los más cercanos
                     st.subheader("Relaves más cercanos")
+                    tabla_cercanos = relaves_cercanos[[
+                        'NOMBRE INSTALACION', 
+                        'NOMBRE_EMPRESA_O_PRODUCTOR_MINERO',
+                        'TIPO_DEPOSITO',
+                        'distancia_km'
+                    ]].rename(columns={
+                        'NOMBRE INSTALACION': 'Nombre',
+                        'NOMBRE_EMPRESA_O_PRODUCTOR_MINERO': 'Empresa',
+                        'TIPO_DEPOSITO': 'Tipo',
+                        'distancia_km': 'Distancia (km)'
+                    })
+                    for columna in ['Nombre', 'Empresa', 'Tipo']:
+                        tabla_cercanos[columna] = display_text_column(tabla_cercanos[columna])
                     st.dataframe(
-                        relaves_cercanos[[
-                            'NOMBRE INSTALACION', 
-                            'NOMBRE_EMPRESA_O_PRODUCTOR_MINERO',
-                            'TIPO_DEPOSITO',
-                            'distancia_km'
-                        ]].rename(columns={
-                            'NOMBRE INSTALACION': 'Nombre',
-                            'NOMBRE_EMPRESA_O_PRODUCTOR_MINERO': 'Empresa',
-                            'TIPO_DEPOSITO': 'Tipo',
-                            'distancia_km': 'Distancia (km)'
-                        }).style.format({'Distancia (km)': '{:.2f}'}),
+                        tabla_cercanos.style.format({'Distancia (km)': '{:.2f}'}),
                         height=200
                     )
                     
                     # Info del más cercano
                     relave_cercano = relaves_cercanos.iloc[0]
-                    relave_cercano_wgs84 = relaves_gdf_wgs84[
-                        relaves_gdf_wgs84['ID'] == relave_cercano['ID']
-                    ].iloc[0]
 
                     with st.expander("🔍 Detalle del relave más cercano", expanded=True):
                         cols = st.columns([1, 1])
@@ -298,84 +557,24 @@ if address:
                         with cols[1]:
                             st.metric(
                                 label="Tipo de depósito", 
-                                value=relave_cercano['TIPO_DEPOSITO']
+                                value=display_text(relave_cercano['TIPO_DEPOSITO'])
                             )
                         
                         st.markdown(f"""
-                        - **Nombre**: {relave_cercano['NOMBRE INSTALACION']}  
-                        - **Empresa**: {relave_cercano['NOMBRE_EMPRESA_O_PRODUCTOR_MINERO']}  
-                        - **Faena**: {relave_cercano['NOMBRE_FAENA']}  
-                        - **Recurso**: {relave_cercano['RECURSO ']}  
+                        - **Nombre**: {display_text(relave_cercano['NOMBRE INSTALACION'])}  
+                        - **Empresa**: {display_text(relave_cercano['NOMBRE_EMPRESA_O_PRODUCTOR_MINERO'])}  
+                        - **Faena**: {display_text(relave_cercano['NOMBRE_FAENA'])}  
+                        - **Recurso**: {display_text(relave_cercano['RECURSO '])}  
                         """)
                     
                     # Mapa
                     st.subheader("Mapa de ubicación")
                     
-                    # Crear mapa
-                    m = folium.Map(
-                        location=[lat, lon],
-                        zoom_start=12,
-                        tiles='CyclOSM'
+                    # Mostrar mapa (HTML cacheado; no se leen eventos del mapa)
+                    st.iframe(
+                        render_result_map_html(lat, lon, region_encontrada['Region'], address),
+                        height=600
                     )
-                    
-                    # Añadir marcador de la dirección ingresada
-                    folium.Marker(
-                        [lat, lon],
-                        popup=folium.Popup(f"<b>Dirección ingresada:</b><br>{address}", max_width=200),
-                        tooltip="Tu ubicación",
-                        icon=folium.Icon(color='green', icon='home', prefix='fa')
-                    ).add_to(m)
-                    
-                    # Añadir marcador del relave más cercano
-                    relave_lat = relave_cercano_wgs84.geometry.y
-                    relave_lon = relave_cercano_wgs84.geometry.x
-                    
-                    
-                    
-                    # Añadir línea de conexión
-                    folium.PolyLine(
-                        locations=[[lat, lon], [relave_lat, relave_lon]],
-                        color='blue',
-                        weight=3,
-                        opacity=0.8,
-                        dash_array='10, 5',
-                        popup=f"Distancia: {relave_cercano['distancia']:.0f} metros"
-                    ).add_to(m)
-                    
-                    # Ajustar vista del mapa
-                    bounds = [[lat, lon], [relave_lat, relave_lon]]
-                    m.fit_bounds(bounds, padding=[20, 20])
-                    
-                    # Añadir otros relaves cercanos
-                    if len(relaves_cercanos) > 1:
-                        for idx, relave in relaves_region_wgs84.iterrows():  
-                                                 
-                            folium.Marker(
-                                [relave.geometry.y, relave.geometry.x],
-                                tooltip=folium.Tooltip(
-                                    f"<b>{relave['NOMBRE INSTALACION']}</b><br>"
-                                    f"Región: {relave['Region']}<br>"
-                                    f"Empresa: {relave['NOMBRE_EMPRESA_O_PRODUCTOR_MINERO']}",
-                                    sticky=True  
-                                ),
-                                # tooltip=relave['NOMBRE INSTALACION'],
-                                icon=folium.Icon(color='blue', icon='map-pin', prefix='fa')
-                                ).add_to(m)
-
-                    folium.CircleMarker(
-                        [relave_lat, relave_lon],
-                        # popup=folium.Popup(
-                            # f"<b>{relave_cercano['NOMBRE INSTALACION']}</b><br>"
-                            # f"Empresa: {relave_cercano['NOMBRE_EMPRESA_O_PRODUCTOR_MINERO']}<br>"
-                            # f"Distancia: {relave_cercano['distancia']:.0f} metros",
-                            # max_width=300
-                        # ),
-                        # tooltip="Relave más cercano",
-                        # icon=folium.Icon(color='red', icon='industry', prefix='fa')
-                    ).add_to(m)
-                    
-                    # Mostrar mapa
-                    st_folium(m, width="100%", height=600, returned_objects=["last_object_clicked"])
                 
             else:
                 st.warning("No se encontró la región para esta ubicación. Asegúrate de ingresar una dirección en Chile.")
@@ -389,24 +588,22 @@ if not address:
     
     cols = st.columns(3)
     with cols[0]:
-        st.metric("Total de relaves", len(relaves_gdf_wgs84))
+        st.metric("Total de relaves", len(relaves_df))
     with cols[1]:
-        st.metric("Regiones con relaves", relaves_gdf_wgs84['REGION'].nunique())
+        st.metric("Regiones con relaves", relaves_df['REGION'].nunique())
     with cols[2]:
-        st.metric("Empresas mineras", relaves_gdf_wgs84['NOMBRE_EMPRESA_O_PRODUCTOR_MINERO'].nunique())
+        st.metric("Empresas mineras", relaves_df['NOMBRE_EMPRESA_O_PRODUCTOR_MINERO'].nunique())
     
     # Mapa general 
     st.subheader("Mapa general de relaves mineros")
     
-    # Obtener mapa cacheado
-    m_general = create_full_map(relaves_gdf_wgs84)
-
-    map_output = st_folium(
-        m_general,
-        width='100%',
-        height=500,
-        key = 'mapa_principal',
-        returned_objects=[]
+    # En móviles se parte con el mapa de calor; los marcadores se cargan a pedido
+    marcadores = st.checkbox("Mostrar marcadores individuales", value=not is_mobile())
+    
+    # Servir el HTML pre-renderado (no se leen eventos del mapa general)
+    st.iframe(
+        full_map_html(relaves_df, relaves_latlon, marcadores, full_map_render_version()),
+        height=500
     )
   
 st.subheader("Fuente de datos")